@@ -23,7 +23,6 @@
 ###########################################################################
 import os.path
 import sys
-from oauth2client.service_account import ServiceAccountCredentials
 
 # try:
 #     with open(os.path.join(sys._MEIPASS,"WCL_API_KEY.txt"), mode="r") as f: API_KEY = f.readline()
@@ -41,8 +40,17 @@ try:
 except AttributeError:
     print("CREDENTIALS not in sys._MEIPASS. Looking for file on local computer.")
     CREDENTIALS_PATH = "C:\ProgramData\Global Speedrunning Scoreboard\JSON_CREDENTIALS.json"
-finally:
-    credentials = ServiceAccountCredentials.from_json_keyfile_name(CREDENTIALS_PATH, scope)
+credentials = None  # Loaded by get_credentials()
+
+
+def get_credentials():
+    """Loads the credentials the first time they are needed, so scoring tools and worker processes can run without them"""
+    global credentials
+    if credentials is None:
+        from oauth2client.service_account import ServiceAccountCredentials
+        credentials = ServiceAccountCredentials.from_json_keyfile_name(CREDENTIALS_PATH, scope)
+    return credentials
+
 
 SEPARATOR = "-" * 64
 ROW_FIRST = 3
@@ -52,8 +60,26 @@ COL_LAST_UPDATE = 4
 COL_USERID = 5
 MIN_LEADERBOARD_SIZE = 3
 TIME_BONUS_DIVISOR = 21600  # 6h (1/4 day) for +100%
+LEADERBOARD_KEPT_RATIO = 0.95  # The last 5% of every leaderboard is ignored
 AUTOUPDATER_OFFSET = 0
 AUTOUPDATER_SHEET_START = 0  # < ROW_FIRST to disable
+FEED_POLL_DELAY = 60  # Seconds between each poll of newly verified runs
+FEED_MAX_LEADERBOARD_PLAYERS = 50  # Queued users under which the other players of the new runs' leaderboards are queued too. 0 to disable
+SCHEDULER_CYCLE_DURATION = 3600  # Seconds per prioritized update cycle
+SCHEDULER_REQUEST_BUDGET = 3000  # Requests to speedrun.com allowed per prioritized update cycle
+SCHEDULER_REQUESTS_PER_USER = 2  # Estimated requests of a user update, before its PBs
+SCHEDULER_REQUESTS_PER_PB = 3  # Estimated requests per PB of a user update (variables, leaderboard, levels)
+SCHEDULER_DEFAULT_PB_COUNT = 20  # Estimated PBs of a user the prioritized updater hasn't updated yet
+SCHEDULER_MAX_STALENESS = 30  # Days after which a user can't get any staler
+SCHEDULER_POINTS_WEIGHT = 1000  # Points for +100% priority
+SCHEDULER_ACTIVITY_WEIGHT = 1  # +100% priority per recently verified run
+POINT_DISTRIBUTION_CACHE_SIZE = 1000  # Users whose points breakdown is kept in memory
+SCORING_PROCESSES = None  # None to use one worker process per core
+SNAPSHOT_WRITE_INTERVAL = 100  # Users recorded between each write of a leaderboard snapshot
+PROFILING = False  # Time every stage of a user update and print a report after each one
+PROFILING_CPROFILE = False  # Profile the next user update with cProfile
+PROFILING_TRACEMALLOC = False  # Trace the memory allocations of the next user update
+PROFILING_TOP_COUNT = 20  # Lines shown in the cProfile and tracemalloc reports
 
 HTTPERROR_RETRY_DELAY = 5
 HTTP_RETRYABLE_ERRORS = [401, 420, 500, 502]
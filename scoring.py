@@ -0,0 +1,484 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+###########################################################################
+# Ava's Global Speedrunning Scoreboard
+# Copyright (C) 2017 Samuel Therrien
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Contact:
+# samuel.06@hotmail.com
+###########################################################################
+import mmap
+import os
+import struct
+import sys
+import time
+import weakref
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import freeze_support
+from threading import Lock
+
+from CONSTANTS import *
+
+
+class SnapshotError(Exception):
+    """ raise SnapshotError({"error":"On Status Label", "details":"Details of error"}) """
+    pass
+
+
+def compact_leaderboard(p_leaderboard: dict) -> tuple:
+    """
+    Returns the runs of a leaderboard as compact columns: (times, valid, player_offsets, players).
+    times is an array of the runs' primary times, valid holds a flag for every run (place > 0 & no banned participant)
+    and the participants' IDs of run i are players[player_offsets[i]:player_offsets[i + 1]] (guests have no ID and are left out).
+
+    Parameters
+    ----------
+    p_leaderboard : dict   # A leaderboard as returned by speedrun.com with "embed=players"
+    """
+    # Get a list of all banned players in this leaderboard
+    banned_players = set()
+    for player in p_leaderboard["data"]["players"]["data"]:
+        if player.get("role") == "banned":
+            banned_players.add(player["id"])
+
+    times = array("d")
+    valid = bytearray()
+    player_offsets = array("q", [0])
+    players = []
+    for run in p_leaderboard["data"]["runs"]:
+        run_players = [player["id"] for player in run["run"]["players"] if player.get("id")]
+        times.append(run["run"]["times"]["primary_t"])
+        valid.append(run["place"] > 0 and banned_players.isdisjoint(run_players))
+        players.extend(run_players)
+        player_offsets.append(len(players))
+    return times, bytes(valid), player_offsets, players
+
+
+def get_leaderboard_stats(p_times: array, p_valid: bytes,
+                          p_min_leaderboard_size: int = MIN_LEADERBOARD_SIZE, p_kept_ratio: float = LEADERBOARD_KEPT_RATIO) -> dict:
+    """
+    Returns the statistics used to give points on a leaderboard or None if it isn't worth any points.
+
+    Parameters
+    ----------
+    p_times : array                # The primary times of every run, in leaderboard order
+    p_valid : bytes                # A flag for every run, see compact_leaderboard()
+    p_min_leaderboard_size : int   # Overrides MIN_LEADERBOARD_SIZE
+    p_kept_ratio : float           # Overrides LEADERBOARD_KEPT_RATIO
+    """
+    if len(p_times) < p_min_leaderboard_size:  # Check to avoid useless computation
+        return None
+    previous_time = p_times[0]
+    is_speedrun = False
+
+    # First iteration: build a list of valid times
+    valid_times = []
+    for value, is_valid in zip(p_times, p_valid):
+        # Making sure this is a speedrun and not a score leaderboard
+        if not is_speedrun:  # To avoid false negatives due to missing primary times, stop comparing once we know it's a speedrun
+            if value < previous_time:
+                break  # Score based leaderboard. No need to keep looking
+            elif value > previous_time:
+                is_speedrun = True
+        if is_valid:
+            valid_times.append(value)
+
+    original_population = len(valid_times)
+    if not is_speedrun or original_population < p_min_leaderboard_size:  # Check to avoid useless computation and errors
+        return None
+    # Sort and remove last 5%
+    valid_times = sorted(valid_times[:int(original_population*p_kept_ratio) or None])
+
+    # Second iteration: maths!
+    mean = 0.0
+    sigma = 0.0
+    population = 0
+    for value in valid_times:
+        population += 1
+        mean_temp = mean
+        mean += (value - mean_temp) / population
+        sigma += (value - mean_temp) * (value - mean)
+
+    standard_deviation = (sigma / population) ** 0.5
+    if standard_deviation <= 0:  # All runs must not have the exact same time
+        return None
+    return {"population": original_population,
+            "mean": mean,
+            "standard_deviation": standard_deviation,
+            "wr_time": valid_times[0],
+            "worst_time": valid_times[-1]}
+
+
+def get_points(p_primary_t: float, p_stats: dict, p_time_bonus_divisor: float = TIME_BONUS_DIVISOR) -> float:
+    """
+    Returns the points worth a time on a leaderboard, before being divided by the game's level count.
+
+    Parameters
+    ----------
+    p_primary_t : float            # The run's primary time
+    p_stats : dict                 # The leaderboard's statistics, see get_leaderboard_stats()
+    p_time_bonus_divisor : float   # Overrides TIME_BONUS_DIVISOR
+    """
+    # Get the +- deviation from the mean
+    signed_deviation = p_stats["mean"] - p_primary_t
+    # Get the deviation from the mean of the worse time as a positive number
+    lowest_deviation = p_stats["worst_time"] - p_stats["mean"]
+    # These three shift the deviations up so that the worse time is now 0
+    adjusted_deviation = signed_deviation+lowest_deviation
+    adjusted_standard_deviation = p_stats["standard_deviation"]+lowest_deviation
+    adjusted_mean_deviation = 0+lowest_deviation
+    if adjusted_deviation <= 0:  # The last 5% of runs isn't worth any points
+        return 0.0
+    # Scale all the normalized deviations so that the mean is worth 1 but the worse stays 0
+    normalized_deviation = (adjusted_deviation/adjusted_standard_deviation) * (1/(adjusted_mean_deviation/adjusted_standard_deviation))
+    # Bonus points for long games
+    length_bonus = (1+(p_stats["wr_time"]/p_time_bonus_divisor))
+    # More people means more accurate relative time and more optimised/hard to reach high times
+    certainty_adjustment = 1-1/p_stats["population"]
+    return ((normalized_deviation * certainty_adjustment) ** 2) * length_bonus * 10
+
+
+def score_compact_leaderboard(p_compact_leaderboard: tuple, p_min_leaderboard_size: int = MIN_LEADERBOARD_SIZE,
+                              p_kept_ratio: float = LEADERBOARD_KEPT_RATIO, p_time_bonus_divisor: float = TIME_BONUS_DIVISOR) -> dict:
+    """
+    Returns the points of every player of a compacted leaderboard as {player_id: points}.
+    Runs in the worker processes of LeaderboardSnapshot.rescore(), so it must stay free of network I/O.
+
+    Parameters
+    ----------
+    p_compact_leaderboard : tuple   # (times, valid, player_offsets, players, level_count), see compact_leaderboard()
+    p_min_leaderboard_size : int    # Overrides MIN_LEADERBOARD_SIZE
+    p_kept_ratio : float            # Overrides LEADERBOARD_KEPT_RATIO
+    p_time_bonus_divisor : float    # Overrides TIME_BONUS_DIVISOR
+    """
+    times, valid, player_offsets, players, level_count = p_compact_leaderboard
+    players_points = {}
+    stats = get_leaderboard_stats(times, valid, p_min_leaderboard_size, p_kept_ratio)
+    if stats:
+        for i, value in enumerate(times):
+            if not valid[i]: continue
+            points = get_points(value, stats, p_time_bonus_divisor) / (level_count or 1)
+            if points > 0:
+                for j in range(player_offsets[i], player_offsets[i + 1]):
+                    player = players[j]
+                    players_points[player] = max(players_points.get(player, 0), points)
+    return players_points
+
+
+def count_best_runs(p_keys: list, p_players_points: iter, p_counted_runs: dict = None) -> dict:
+    """
+    Returns the points of every player's best run per category as {player_id: {(category, level): points}}.
+
+    Parameters
+    ----------
+    p_keys : list            # The (category, level) of every leaderboard
+    p_players_points : iter  # The {player_id: points} of every leaderboard, see score_compact_leaderboard()
+    p_counted_runs : dict    # Previously counted runs to merge with, updated in place
+    """
+    # If a category has already been counted, only keep the one that's worth the most.
+    # This can happen in leaderboards with multiple coop runs or multiple subcategories.
+    counted_runs = {} if p_counted_runs is None else p_counted_runs
+    for key, players_points in zip(p_keys, p_players_points):
+        for player, points in players_points.items():
+            player_runs = counted_runs.setdefault(player, {})
+            player_runs[key] = max(player_runs.get(key, 0), points)
+    return counted_runs
+
+
+def sum_best_runs(p_counted_runs: dict) -> dict:
+    """
+    Returns the total points of every player as {player_id: points}.
+
+    Parameters
+    ----------
+    p_counted_runs : dict   # The best runs of every player, see count_best_runs()
+    """
+    # Sum up the runs' score
+    users_points = {}
+    for player, player_runs in p_counted_runs.items():
+        points = sum(player_runs.values())
+        users_points[player] = points if points >= 1 else 0  # Users need at least 1 point
+    return users_points
+
+
+SNAPSHOT_MAGIC = b"GSSSNAP1"
+SNAPSHOT_HEADER = struct.Struct("<8s5q")  # Magic, leaderboard count, run count, player count, string count, string bytes
+
+
+def _write_snapshot_column(p_file, p_column: array) -> None:
+    # Columns are little-endian and padded to 8 bytes so they can be cast in place once memory-mapped
+    if sys.byteorder != "little":
+        p_column = array(p_column.typecode, p_column)
+        p_column.byteswap()
+    data = p_column.tobytes()
+    p_file.write(data)
+    p_file.write(bytes(-len(data) % 8))
+
+
+class LeaderboardSnapshotWriter:
+    """
+    Collects fetched leaderboards to dump them in a columnar snapshot file that LeaderboardSnapshot can replay offline.
+    user_updater.record_snapshot() sets user_updater.snapshot_writer to one to record every leaderboard fetched by Run.
+    """
+
+    def __init__(self) -> None:
+        self._lock = Lock()
+        self._leaderboard_keys = set()
+        self._strings = {}  # {string: index} of the interned string table
+        self.leaderboard_run_offsets = array("q", [0])
+        self.leaderboard_games = array("i")
+        self.leaderboard_categories = array("i")
+        self.leaderboard_levels = array("i")  # -1 for full game leaderboards
+        self.leaderboard_level_counts = array("i")
+        self.run_times = array("d")
+        self.run_valid = array("B")
+        self.run_player_offsets = array("q", [0])
+        self.run_players = array("i")
+
+    def __len__(self) -> int:
+        return len(self.leaderboard_games)
+
+    def __contains__(self, p_leaderboard: dict) -> bool:
+        return self.get_key(p_leaderboard) in self._leaderboard_keys
+
+    @staticmethod
+    def get_key(p_leaderboard: dict) -> tuple:
+        data = p_leaderboard["data"]
+        return data["game"], data["category"], data["level"], tuple(sorted(data["values"].items()))
+
+    def _intern(self, p_string: str) -> int:
+        return self._strings.setdefault(p_string, len(self._strings))
+
+    def add(self, p_leaderboard: dict, p_level_count: int) -> None:
+        """Adds a leaderboard as returned by speedrun.com with "embed=players". Leaderboards already added are skipped"""
+        times, valid, player_offsets, players = compact_leaderboard(p_leaderboard)
+        with self._lock:
+            key = self.get_key(p_leaderboard)
+            if key in self._leaderboard_keys: return
+            self._leaderboard_keys.add(key)
+            self.leaderboard_games.append(self._intern(p_leaderboard["data"]["game"]))
+            self.leaderboard_categories.append(self._intern(p_leaderboard["data"]["category"]))
+            self.leaderboard_levels.append(self._intern(p_leaderboard["data"]["level"]) if p_leaderboard["data"]["level"] else -1)
+            self.leaderboard_level_counts.append(p_level_count)
+            self.run_times.extend(times)
+            self.run_valid.frombytes(valid)
+            first_player = len(self.run_players)
+            self.run_players.extend(self._intern(player) for player in players)
+            self.run_player_offsets.extend(first_player + offset for offset in player_offsets[1:])
+            self.leaderboard_run_offsets.append(len(self.run_times))
+
+    def write(self, p_path: str) -> None:
+        with self._lock:
+            strings = [string.encode("utf-8") for string in self._strings]  # Dicts keep insertion order, so index order
+            string_offsets = array("q", [0])
+            for string in strings:
+                string_offsets.append(string_offsets[-1] + len(string))
+            with open(p_path, "wb") as file:
+                file.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, len(self), len(self.run_times), len(self.run_players),
+                                                len(strings), string_offsets[-1]))
+                for column in (self.leaderboard_run_offsets, self.leaderboard_games, self.leaderboard_categories,
+                               self.leaderboard_levels, self.leaderboard_level_counts, self.run_times, self.run_valid,
+                               self.run_player_offsets, self.run_players, string_offsets):
+                    _write_snapshot_column(file, column)
+                file.write(b"".join(strings))
+        print("Wrote {} leaderboards ({} runs) to {}".format(len(self), len(self.run_times), p_path))
+
+
+class LeaderboardSnapshot:
+    """
+    Memory-mapped reader of a file written by LeaderboardSnapshotWriter. Columns are read in place, without parsing or copying.
+    with LeaderboardSnapshot(path) as snapshot: users_points = snapshot.rescore(p_time_bonus_divisor=43200)
+    """
+
+    def __init__(self, p_path: str) -> None:
+        if sys.byteorder != "little":
+            raise SnapshotError({"error": "Unsupported snapshot", "details": "Snapshots can only be read on little-endian machines"})
+        self.path = p_path
+        self._views = []  # Weak references to every view of the map handed out, released on close()
+        self._mmap = None
+        try:
+            self._file = open(p_path, "rb")
+        except OSError as exception:
+            raise SnapshotError({"error": "Can't open snapshot", "details": exception})
+        try:
+            self.__map()
+        except BaseException:
+            self.close()
+            raise
+
+    def __map(self) -> None:
+        def invalid(p_details: str) -> SnapshotError:
+            return SnapshotError({"error": "Invalid snapshot", "details": "{} {}".format(self.path, p_details)})
+
+        file_size = os.fstat(self._file.fileno()).st_size
+        if file_size < SNAPSHOT_HEADER.size:
+            raise invalid("is too small to be a leaderboard snapshot")
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, leaderboard_count, run_count, player_count, string_count, string_bytes = SNAPSHOT_HEADER.unpack_from(self._mmap)
+        if magic != SNAPSHOT_MAGIC:
+            raise invalid("is not a leaderboard snapshot")
+        if min(leaderboard_count, run_count, player_count, string_count, string_bytes) < 0:
+            raise invalid("has a corrupted header")
+
+        columns = (("q", leaderboard_count + 1), ("i", leaderboard_count), ("i", leaderboard_count), ("i", leaderboard_count),
+                   ("i", leaderboard_count), ("d", run_count), ("B", run_count), ("q", run_count + 1), ("i", player_count),
+                   ("q", string_count + 1))
+        sizes = [struct.calcsize(format_) * length for format_, length in columns]
+        expected_size = SNAPSHOT_HEADER.size + sum(size + (-size % 8) for size in sizes) + string_bytes
+        if file_size < expected_size:
+            raise invalid("is truncated ({} bytes out of {})".format(file_size, expected_size))
+
+        view = self._export(memoryview(self._mmap))
+        position = SNAPSHOT_HEADER.size
+        views = []
+        for (format_, _), size in zip(columns, sizes):
+            views.append(self._export(view[position:position + size].cast(format_)))
+            position += size + (-size % 8)
+        (self.leaderboard_run_offsets, self.leaderboard_games, self.leaderboard_categories, self.leaderboard_levels,
+         self.leaderboard_level_counts, self.run_times, self.run_valid, self.run_player_offsets, self.run_players,
+         self.string_offsets) = views
+        self.string_bytes = self._export(view[position:position + string_bytes])
+        if (self.leaderboard_run_offsets[-1], self.run_player_offsets[-1], self.string_offsets[-1]) != (run_count, player_count, string_bytes):
+            raise invalid("has corrupted offsets")
+
+    def _export(self, p_view: memoryview) -> memoryview:
+        if len(self._views) > 1024:
+            self._views = [view for view in self._views if view() is not None]
+        self._views.append(weakref.ref(p_view))
+        return p_view
+
+    def __len__(self) -> int:
+        return len(self.leaderboard_games)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def close(self) -> None:
+        # Every view of the map has to be released before it can be closed, including the ones still held by callers
+        for view in reversed(self._views):
+            view = view()
+            if view is not None: view.release()
+        self._views = []
+        if self._mmap is not None: self._mmap.close()
+        self._file.close()
+
+    def get_string(self, p_index: int) -> str:
+        return str(self.string_bytes[self.string_offsets[p_index]:self.string_offsets[p_index + 1]], "utf-8")
+
+    def get_key(self, p_index: int) -> tuple:
+        """Returns the (category, level) of a leaderboard, as used to only count the best run per category"""
+        level = self.leaderboard_levels[p_index]
+        return self.get_string(self.leaderboard_categories[p_index]), self.get_string(level) if level >= 0 else None
+
+    def get_compact_leaderboard(self, p_index: int) -> tuple:
+        """
+        Returns a leaderboard as (times, valid, player_offsets, players, level_count), see score_compact_leaderboard().
+        Every column is a view of the map: the offsets index the snapshot's whole players column, whose players are string table indexes.
+        """
+        start, end = self.leaderboard_run_offsets[p_index], self.leaderboard_run_offsets[p_index + 1]
+        return (self._export(self.run_times[start:end]), self._export(self.run_valid[start:end]),
+                self._export(self.run_player_offsets[start:end + 1]), self.run_players, self.leaderboard_level_counts[p_index])
+
+    def count_best_runs(self, p_start: int, p_end: int, p_scoring: dict) -> dict:
+        """
+        Returns the best runs of every player in a range of leaderboards, see count_best_runs().
+        Players and keys are string table indexes, which stay valid across processes reading the same snapshot.
+        """
+        keys = [(self.leaderboard_categories[i], self.leaderboard_levels[i]) for i in range(p_start, p_end)]
+        players_points = (score_compact_leaderboard(self.get_compact_leaderboard(i), **p_scoring) for i in range(p_start, p_end))
+        return count_best_runs(keys, players_points)
+
+    def rescore(self, p_min_leaderboard_size: int = MIN_LEADERBOARD_SIZE, p_kept_ratio: float = LEADERBOARD_KEPT_RATIO,
+                p_time_bonus_divisor: float = TIME_BONUS_DIVISOR, p_processes: int = SCORING_PROCESSES) -> dict:
+        """
+        Returns the points of every player as {player_id: points} under the given scoring constants, fully offline.
+        Leaderboards are sharded across a pool of worker processes that each map the snapshot, or scored in this process if p_processes is 1.
+        As worker processes re-import the main module, only use a pool from behind an "if __name__ == '__main__':" guard.
+        """
+        scoring = {"p_min_leaderboard_size": p_min_leaderboard_size, "p_kept_ratio": p_kept_ratio, "p_time_bonus_divisor": p_time_bonus_divisor}
+        if p_processes == 1:  # A single worker process would only add overhead
+            counted_runs = self.count_best_runs(0, len(self), scoring)
+        else:
+            # Shards of about the same amount of runs, a few per process so that they stay busy until the end
+            shard_count = min(len(self), (p_processes or os.cpu_count() or 1) * 4) or 1
+            run_count = self.leaderboard_run_offsets[-1]
+            bounds = [0]
+            for i in range(1, len(self)):
+                if self.leaderboard_run_offsets[i] >= run_count * len(bounds) / shard_count: bounds.append(i)
+            bounds.append(len(self))
+            counted_runs = {}
+            with ProcessPoolExecutor(max_workers=p_processes) as executor:
+                shards = [executor.submit(score_snapshot_shard, self.path, start, end, scoring) for start, end in zip(bounds, bounds[1:])]
+                for shard in shards:
+                    for player, player_runs in shard.result().items():
+                        counted_player_runs = counted_runs.setdefault(player, {})
+                        for key, points in player_runs.items():
+                            counted_player_runs[key] = max(counted_player_runs.get(key, 0), points)
+        return {self.get_string(player): points for player, points in sum_best_runs(counted_runs).items()}
+
+
+def score_snapshot_shard(p_path: str, p_start: int, p_end: int, p_scoring: dict) -> dict:
+    """
+    Runs in the worker processes of LeaderboardSnapshot.rescore(). Maps the snapshot in this process so only a range is pickled.
+
+    Parameters
+    ----------
+    p_path : str        # The snapshot file
+    p_start : int       # The first leaderboard of the shard
+    p_end : int         # The leaderboard after the last one of the shard
+    p_scoring : dict    # Keyword arguments of score_compact_leaderboard()
+    """
+    with LeaderboardSnapshot(p_path) as snapshot:
+        return snapshot.count_best_runs(p_start, p_end, p_scoring)
+
+
+if __name__ == "__main__":
+    # Full scoreboard recomputation from a leaderboard snapshot, without querying speedrun.com
+    freeze_support()  # Worker processes of frozen executables start by re-running this
+    import argparse
+    parser = argparse.ArgumentParser(description="Rescore every player of a leaderboard snapshot")
+    parser.add_argument("snapshot", help="File written by LeaderboardSnapshotWriter, see \"python user_updater.py --help\"")
+    parser.add_argument("--processes", type=int, default=SCORING_PROCESSES, help="Worker processes, 1 to score in this process")
+    parser.add_argument("--min-leaderboard-size", type=int, default=MIN_LEADERBOARD_SIZE)
+    parser.add_argument("--kept-ratio", type=float, default=LEADERBOARD_KEPT_RATIO)
+    parser.add_argument("--time-bonus-divisor", type=float, default=TIME_BONUS_DIVISOR)
+    parser.add_argument("--top", type=int, default=100, help="Amount of players to print")
+    parser.add_argument("--benchmark", action="store_true", help="Time the rescore from 1 up to --processes worker processes instead")
+    args = parser.parse_args()
+
+    if args.benchmark:
+        with LeaderboardSnapshot(args.snapshot) as snapshot:
+            reference_time = reference_points = None
+            for processes in range(1, (args.processes or os.cpu_count() or 1) + 1):
+                start = time.perf_counter()
+                users_points = snapshot.rescore(args.min_leaderboard_size, args.kept_ratio, args.time_bonus_divisor, processes)
+                elapsed = time.perf_counter() - start
+                if reference_time is None: reference_time, reference_points = elapsed, users_points
+                print("{:>3} processes | {:>8.3f}s | {:>5.2f}x | {}".format(processes, elapsed, reference_time / elapsed,
+                                                                          "same points" if users_points == reference_points else "DIFFERENT POINTS"))
+        sys.exit()
+
+    start = time.perf_counter()
+    with LeaderboardSnapshot(args.snapshot) as snapshot:
+        users_points = snapshot.rescore(args.min_leaderboard_size, args.kept_ratio, args.time_bonus_divisor, args.processes)
+    print("Rescored {} players in {:.3f}s".format(len(users_points), time.perf_counter() - start))
+    for rank, (player, points) in enumerate(sorted(users_points.items(), key=lambda item: item[1], reverse=True)[:args.top], 1):
+        print("{:>5} | {:<8} | {:.2f}".format(rank, player, points))
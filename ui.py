@@ -79,6 +79,15 @@ def update_user_thread(p_code, p_statusLabel):
     update_userButton.configure(state=NORMAL)
 
 
+def show_point_distribution():
+    point_distribution = get_point_distribution(entry.get())
+    if point_distribution:
+        statusLabel.configure(text="Points breakdown from the last successful update of {}".format(entry.get()))
+        write_text(point_distribution.to_str())
+    else:
+        statusLabel.configure(text="{} wasn't updated yet. Update the runner first.".format(entry.get()))
+
+
 def copy():
     window.clipboard_clear()
     window.clipboard_append(text.get('1.0', END))
@@ -145,6 +154,9 @@ buttonsFrame.pack(fill=X, padx=4, pady=4)
 # Update User Button
 update_userButton = Button(buttonsFrame, text="Update runner", command=update_user)
 update_userButton.pack(side=LEFT, padx=(0, 4))
+# Points Breakdown Button
+button = Button(buttonsFrame, text="Show points breakdown", command=show_point_distribution)
+button.pack(side=LEFT, padx=4)
 # Clipboard Button
 button = Button(buttonsFrame, text="Copy to clipboard", command=copy)
 button.pack(side=LEFT, padx=4)
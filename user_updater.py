@@ -21,14 +21,22 @@
 # Contact:
 # samuel.06@hotmail.com
 ###########################################################################
+import cProfile
+import heapq
+import io
 import json
 import math
+import pstats
 import time
+import tracemalloc
 import traceback
 import re
-from collections import Counter
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar, copy_context
+from itertools import count
 from sys import stdout
-from threading import Thread
+from threading import Lock, Thread
 
 import gspread
 import httplib2
@@ -36,6 +44,7 @@ import oauth2client
 import requests
 
 from CONSTANTS import *
+from scoring import *
 
 
 def print(string):
@@ -52,6 +61,123 @@ class SpeedrunComError(UserUpdaterError):
     pass
 
 
+class UpdateProfile:
+    """ The stage timings, cProfile and tracemalloc captures of a single user update. """
+
+    def __init__(self, p_enabled: bool, p_capture_cprofile: bool) -> None:
+        self.enabled = p_enabled
+        self.capture_cprofile = p_capture_cprofile
+        self.started_tracemalloc = False
+        self.profilers = []  # One cProfile.Profile per thread of the update
+        self.stages = {}  # {stage: [count, total, max]} in the order they were first entered
+        self.start = time.perf_counter()
+        self.lock = Lock()
+
+    def add_stage_time(self, p_name: str, p_elapsed: float) -> None:
+        with self.lock:
+            stage = self.stages.setdefault(p_name, [0, 0.0, 0.0])
+            stage[0] += 1
+            stage[1] += p_elapsed
+            stage[2] = max(stage[2], p_elapsed)
+
+    def report(self) -> str:
+        with self.lock:
+            wall_time = time.perf_counter() - self.start
+            report_str = "{}\nStage timings over {:.3f}s (threaded stages can add up to more than that):\n" \
+                         "{:<20} | {:>5} | {:>9} | {:>9} | {:>9}".format(SEPARATOR, wall_time, "Stage", "Count", "Total", "Mean", "Max")
+            for name, (count, total, max_) in self.stages.items():
+                report_str += "\n{:<20} | {:>5} | {:>8.3f}s | {:>8.3f}s | {:>8.3f}s".format(name, count, total, total / count, max_)
+        return report_str
+
+
+# The UpdateProfile of the user update running in the current context. User.set_points() passes it to its threads
+update_profile = ContextVar("update_profile", default=None)
+
+
+class StageTimer:
+    """
+    Times the stages of the update pipeline. Every user update gets its own UpdateProfile, so concurrent updates don't mix.
+    Set enabled to time the stages, and capture_cprofile/capture_tracemalloc to profile the next user update only.
+    """
+
+    def __init__(self) -> None:
+        self.enabled = PROFILING
+        self.capture_cprofile = PROFILING_CPROFILE
+        self.capture_tracemalloc = PROFILING_TRACEMALLOC
+        self._lock = Lock()
+
+    @contextmanager
+    def stage(self, p_name: str):
+        profile = update_profile.get()
+        if not (profile and profile.enabled):
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            profile.add_stage_time(p_name, time.perf_counter() - start)
+
+    def run_profiled(self, p_function: callable, *args) -> None:
+        """Runs a function of the current user update, profiling its thread too if the update is being captured"""
+        profile = update_profile.get()
+        if not (profile and profile.capture_cprofile):
+            return p_function(*args)
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:  # Python 3.12+ only allows one active profiler, the calling thread's
+            return p_function(*args)
+        with profile.lock:
+            profile.profilers.append(profiler)
+        try:
+            return p_function(*args)
+        finally:
+            profiler.disable()
+
+    def start_capture(self) -> object:
+        """Called at the start of get_updated_user(). Returns the token to pass to stop_capture()"""
+        with self._lock:
+            # Captures are one-shot: only the first update to start after they are requested gets them
+            profile = UpdateProfile(self.enabled, self.capture_cprofile)
+            self.capture_cprofile = False
+            if self.capture_tracemalloc and not tracemalloc.is_tracing():
+                tracemalloc.start()
+                profile.started_tracemalloc = True
+                self.capture_tracemalloc = False
+        if profile.capture_cprofile:
+            profiler = cProfile.Profile()
+            profile.profilers.append(profiler)
+            profiler.enable()
+        return update_profile.set(profile)
+
+    def stop_capture(self, p_token: object) -> None:
+        """Called at the end of get_updated_user(). Prints the report of this user update"""
+        profile = update_profile.get()
+        update_profile.reset(p_token)
+        if profile.capture_cprofile:
+            profile.profilers[0].disable()  # The calling thread's, the others stopped with their thread
+        if profile.started_tracemalloc and tracemalloc.is_tracing():
+            # Snapshot before building the reports so their own allocations aren't traced
+            snapshot = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            print("{}\ntracemalloc report: {:.1f} KiB allocated, {:.1f} KiB peak".format(SEPARATOR, current / 1024, peak / 1024))
+            for stat in snapshot.statistics("lineno")[:PROFILING_TOP_COUNT]: print(stat)
+        if profile.capture_cprofile:
+            stream = io.StringIO()
+            pstats.Stats(*profile.profilers, stream=stream).sort_stats("cumulative").print_stats(PROFILING_TOP_COUNT)
+            print("{}\ncProfile report ({} threads):\n{}".format(SEPARATOR, len(profile.profilers), stream.getvalue()))
+        if profile.enabled:
+            print(profile.report())
+
+
+stage_timer = StageTimer()
+
+
+snapshot_writer = None  # Set to a LeaderboardSnapshotWriter to record every leaderboard fetched by Run
+
+
 class Run():
     id_ = ""
     primary_t = 0.0
@@ -63,6 +189,7 @@ class Run():
     level = ""
     level_name = ""
     level_count = 0
+    leaderboard_stats = None
     _points = 0
 
     def __init__(self, id_, primary_t, game, category, variables={}, level=""):
@@ -92,103 +219,136 @@ class Run():
 
     def __set_points(self):
         self._points = 0
-        # If the run is an Individual Level, adapt the request url
-        lvl_cat_str = "level/{level}/".format(level=self.level) if self.level else "category/"
-        url = "https://www.speedrun.com/api/v1/leaderboards/{game}/" \
-              "{lvl_cat_str}{category}?video-only=true&embed=players".format(game=self.game, lvl_cat_str=lvl_cat_str, category=self.category)
-        for var_id, var_value in self.variables.items():
-            url += "&var-{id}={value}".format(id=var_id, value=var_value)
-        leaderboard = get_file(url)
-
-        if len(leaderboard["data"]["runs"]) >= MIN_LEADERBOARD_SIZE:  # Check to avoid useless computation
-            previous_time = leaderboard["data"]["runs"][0]["run"]["times"]["primary_t"]
-            is_speedrun = False
-
-            # Get a list of all banned players in this leaderboard
-            banned_players = []
-            for player in leaderboard["data"]["players"]["data"]:
-                if player.get("role") == "banned":
-                    banned_players.append(player["id"])
-
-            # First iteration: build a list of valid runs
-            valid_runs = []
-            for run in leaderboard["data"]["runs"]:
-                value = run["run"]["times"]["primary_t"]
-
-                # Making sure this is a speedrun and not a score leaderboard
-                if not is_speedrun:  # To avoid false negatives due to missing primary times, stop comparing once we know it's a speedrun
-                    if value < previous_time:
-                        break  # Score based leaderboard. No need to keep looking
-                    elif value > previous_time:
-                        is_speedrun = True
-
-                # Check if the run is valid (place > 0 & no banned participant)
-                if run["place"] > 0:
-                    for player in run["run"]["players"]:
-                        if player.get("id") in banned_players: break
-                    else:
-                        valid_runs.append(run)
-
-            original_population = len(valid_runs)
-            if is_speedrun and original_population >= MIN_LEADERBOARD_SIZE:  # Check to avoid useless computation and errors
-                # Sort and remove last 5%
-                valid_runs = sorted(valid_runs[:int(original_population*0.95) or None], key=lambda r: r["run"]["times"]["primary_t"])
-
-                # Second iteration: maths!
-                mean = 0.0
-                sigma = 0.0
-                population = 0
-                for run in valid_runs:
-                    value = run["run"]["times"]["primary_t"]
-                    population += 1
-                    mean_temp = mean
-                    mean += (value - mean_temp) / population
-                    sigma += (value - mean_temp) * (value - mean)
-
-                wr_time = valid_runs[0]["run"]["times"]["primary_t"]
-                worst_time = valid_runs[-1]["run"]["times"]["primary_t"]
-                standard_deviation = (sigma / population) ** 0.5
-                if standard_deviation > 0:  # All runs must not have the exact same time
-                    # Get the +- deviation from the mean
-                    signed_deviation = mean - self.primary_t
-                    # Get the deviation from the mean of the worse time as a positive number
-                    lowest_deviation = worst_time - mean
-                    # These three shift the deviations up so that the worse time is now 0
-                    adjusted_deviation = signed_deviation+lowest_deviation
-                    adjusted_standard_deviation = standard_deviation+lowest_deviation
-                    adjusted_mean_deviation = 0+lowest_deviation
-                    if adjusted_deviation > 0:  # The last 5% of runs isn't worth any points
-                        # Scale all the normalized deviations so that the mean is worth 1 but the worse stays 0
-                        normalized_deviation = (adjusted_deviation/adjusted_standard_deviation) * (1/(adjusted_mean_deviation/adjusted_standard_deviation))
-                        # Bonus points for long games
-                        length_bonus = (1+(wr_time/TIME_BONUS_DIVISOR))
-                        # More people means more accurate relative time and more optimised/hard to reach high times
-                        certainty_adjustment = 1-1/original_population
-
-                        # Give points
-                        self._points = ((normalized_deviation * certainty_adjustment) ** 2) * length_bonus * 10
-                        # Set names
-                        game_category = re.split("/|#", leaderboard["data"]["weblink"][leaderboard["data"]["weblink"].rindex("com/")+4:].replace("_", " ").title())
-                        self.game_name = game_category[0]  # Always first of 2-3 items
-                        self.category_name = game_category[-1]  # Always last of 2-3 items
-
-                        # If the run is an Individual Level and worth looking at, set the level count and name
-                        if self.level and self._points > 0:
-                            self.level_name = game_category[1]  # Always 2nd of 3 items
-                            url = "https://www.speedrun.com/api/v1/games/{game}/levels".format(game=self.game)
-                            levels = get_file(url)
-                            self.level_count = len(levels["data"])
-                            self._points /= self.level_count or 1
+        with stage_timer.stage("fetch leaderboard"):
+            leaderboard = get_file(get_leaderboard_url(self.game, self.category, self.variables, self.level))
+
+        with stage_timer.stage("scoring"):
+            times, valid, _, _ = compact_leaderboard(leaderboard)
+            stats = get_leaderboard_stats(times, valid)
+            if stats:
+                # Give points
+                self._points = get_points(self.primary_t, stats)
+        self.leaderboard_stats = stats
+        if self._points > 0:  # The last 5% of runs isn't worth any points
+            # Set names
+            game_category = re.split("/|#", leaderboard["data"]["weblink"][leaderboard["data"]["weblink"].rindex("com/")+4:].replace("_", " ").title())
+            self.game_name = game_category[0]  # Always first of 2-3 items
+            self.category_name = game_category[-1]  # Always last of 2-3 items
+
+            # If the run is an Individual Level and worth looking at, set the level count and name
+            if self.level:
+                self.level_name = game_category[1]  # Always 2nd of 3 items
+                url = "https://www.speedrun.com/api/v1/games/{game}/levels".format(game=self.game)
+                levels = get_file(url)
+                self.level_count = len(levels["data"])
+                self._points /= self.level_count or 1
+
+        if snapshot_writer is not None and leaderboard not in snapshot_writer:
+            if self.level and not self.level_count:  # What-if scoring needs the level count even if this run isn't worth any points
+                url = "https://www.speedrun.com/api/v1/games/{game}/levels".format(game=self.game)
+                self.level_count = len(get_file(url)["data"])
+            snapshot_writer.add(leaderboard, self.level_count)
         print(self)
 
 
+class PointDistribution:
+    """ The breakdown of a user's points per run. Renders are built on demand and kept along with the breakdown. """
+
+    def __init__(self, p_points: float, p_runs: list) -> None:
+        self.points = p_points
+        self.runs = p_runs  # [{"game", "category", "level", "points", "leaderboard"}] sorted by points
+        self._str = None
+        self._json = None
+
+    def __eq__(self, other):
+        return isinstance(other, PointDistribution) and (self.points, self.runs) == (other.points, other.runs)
+
+    def __ne__(self, other):
+        return not (self == other)
+
+    def to_str(self) -> str:
+        if self._str is None:
+            run_str_lst = []
+            for run in self.runs:
+                run_str_lst.append("{game} - {category}{level}".format(game=run["game"],
+                                                                       category=run["category"],
+                                                                       level=" ({})".format(run["level"]) if run["level"] else ""))
+            biggest_str_length = max(map(len, run_str_lst), default=0)
+            lines = ["", "{:<{}} | Points".format("Game - Category (Level)", biggest_str_length), "{} | -----".format("-"*biggest_str_length)]
+            for run_str, run in zip(run_str_lst, self.runs):
+                lines.append("{game_cat_lvl:<{length}} | {points:.2f}".format(game_cat_lvl=run_str, length=biggest_str_length,
+                                                                               points=math.ceil((run["points"] * 100)) / 100))
+            self._str = "\n".join(lines)
+        return self._str
+
+    def to_json(self) -> str:
+        if self._json is None:
+            self._json = json.dumps({"points": self.points, "runs": self.runs})
+        return self._json
+
+
+class PointDistributionCache:
+    """
+    Thread-safe LRU cache of the point distributions of the last POINT_DISTRIBUTION_CACHE_SIZE users successfully updated.
+    Users can be looked up by ID or by any name they were updated with.
+    """
+
+    def __init__(self, p_size: int) -> None:
+        self._size = p_size
+        self._distributions = OrderedDict()  # {user_id: (PointDistribution, {names})} from least to most recently updated
+        self._ids = {}  # {name: user_id}
+        self._lock = Lock()
+
+    def get(self, p_user_id_or_name: str) -> PointDistribution:
+        with self._lock:
+            user_id = p_user_id_or_name if p_user_id_or_name in self._distributions else self._ids.get(p_user_id_or_name.lower())
+            return self._distributions[user_id][0] if user_id else None
+
+    def put(self, p_user_id: str, p_name: str, p_point_distribution: PointDistribution) -> PointDistribution:
+        """Returns the cached point distribution, which is only replaced (along with its renders) if it changed"""
+        with self._lock:
+            point_distribution, names = self._distributions.pop(p_user_id, (None, set()))
+            if point_distribution != p_point_distribution:
+                point_distribution = p_point_distribution
+            previous_id = self._ids.get(p_name.lower())
+            if previous_id not in (None, p_user_id):  # Names can change hands
+                self._distributions[previous_id][1].discard(p_name.lower())
+            names.add(p_name.lower())
+            self._ids[p_name.lower()] = p_user_id
+            self._distributions[p_user_id] = (point_distribution, names)
+            while len(self._distributions) > self._size:
+                _, (_, evicted_names) = self._distributions.popitem(last=False)
+                for name in evicted_names: self._ids.pop(name, None)
+            return point_distribution
+
+    def remove(self, p_user_id: str) -> None:
+        with self._lock:
+            _, names = self._distributions.pop(p_user_id, (None, ()))
+            for name in names: self._ids.pop(name, None)
+
+
+point_distributions = PointDistributionCache(POINT_DISTRIBUTION_CACHE_SIZE)
+
+
+def get_point_distribution(p_user_id: str) -> PointDistribution:
+    """
+    Returns the point distribution of the last successful update of a user, or None if it isn't cached.
+    Doesn't query speedrun.com.
+
+    Parameters
+    ----------
+    p_user_id : str   # The user's ID or the name it was updated with
+    """
+    return point_distributions.get(p_user_id)
+
+
 class User:
     _points = 0
     _name = ""
     _weblink = ""
     _id = ""
     _banned = False
-    _point_distribution_str = ""
+    _point_distribution = None
 
     def __init__(self, id_or_name: str) -> None:
         self._id = id_or_name
@@ -222,22 +382,7 @@ class User:
             try:
                 # Check if it's a valid run (has a category AND has video verification)
                 if pb["run"]["category"] and pb["run"].get("videos"):
-                    # Get a list of the game's subcategory variables
-                    url = "https://www.speedrun.com/api/v1/games/{game}/variables".format(game=pb["run"]["game"])
-                    game_variables = get_file(url)
-                    game_subcategory_ids = []
-                    for game_variable in game_variables["data"]:
-                        if game_variable["is-subcategory"]:
-                            game_subcategory_ids.append(game_variable["id"])
-
-                    pb_subcategory_variables = {}
-                    # For every variable in the run...
-                    for pb_var_id, pb_var_value in pb["run"]["values"].items():
-                        # ...find if said variable is one of the game's subcategories...
-                        if pb_var_id in game_subcategory_ids:
-                            # ... and add it to the run's subcategory variables
-                            pb_subcategory_variables[pb_var_id] = pb_var_value
-
+                    pb_subcategory_variables = get_subcategory_variables(pb["run"]["values"], get_subcategory_ids(pb["run"]["game"]))
                     run = Run(pb["run"]["id"], pb["run"]["times"]["primary_t"], pb["run"]["game"], pb["run"]["category"], pb_subcategory_variables, pb["run"]["level"])
                     # If a category has already been counted, only keep the one that's worth the most.
                     # This can happen in leaderboards with multiple coop runs or multiple subcategories.
@@ -259,34 +404,30 @@ class User:
 
         if not self._banned:
             url = "https://www.speedrun.com/api/v1/users/{user}/personal-bests".format(user=self._id)
-            pbs = get_file(url)
+            with stage_timer.stage("fetch PBs"):
+                pbs = get_file(url)
             self._points = 0
             update_progress(0, len(pbs["data"]))
             threads = []
             for pb in pbs["data"]:
-                threads.append(Thread(target=set_points_thread, args=(pb,)))
+                threads.append(Thread(target=copy_context().run, args=(stage_timer.run_profiled, set_points_thread, pb)))
             for t in threads: t.start()
             for t in threads: t.join()
 
             # Sum up the runs' score
             counted_runs.sort(key=lambda r: r._points, reverse=True)
-            run_str_lst = []
-            biggest_str_length = 0
+            run_infos_lst = []
             for run in counted_runs:
                 self._points += run._points
-                run_str = ("{game} - {category}{level}".format(game=run.game_name,
-                                                               category=run.category_name,
-                                                               level=" ({})".format(run.level_name) if run.level_name else ""))
-                run_pts = math.ceil((run._points * 100)) / 100
-                run_str_lst.append((run_str, run_pts))
-                biggest_str_length = max(biggest_str_length, len(run_str))
-
-            self._point_distribution_str = "\n{:<{}} | Points\n{} | -----".format("Game - Category (Level)", biggest_str_length, "-"*biggest_str_length)
-            for run_infos in run_str_lst:
-                self._point_distribution_str += "\n{game_cat_lvl:<{length}} | {points:.2f}".format(game_cat_lvl=run_infos[0], length=biggest_str_length, points=run_infos[1])
+                run_infos_lst.append({"game": run.game_name,
+                                      "category": run.category_name,
+                                      "level": run.level_name,
+                                      "points": run._points,
+                                      "leaderboard": run.leaderboard_stats})
 
             if self._banned or self._points < 1:
                 self._points = 0  # In case the banned flag has been set mid-thread or the user doesn't have at least 1 point
+            self._point_distribution = PointDistribution(self._points, run_infos_lst)
         else:
             self._points = 0
         update_progress(1, 0)
@@ -295,6 +436,78 @@ class User:
 session = requests.Session()
 
 
+class RequestCounter:
+    """ Thread-safe count of the requests sent to speedrun.com by whoever set it in request_counter. """
+
+    def __init__(self) -> None:
+        self.count = 0
+        self._lock = Lock()
+
+    def increment(self) -> None:
+        with self._lock:
+            self.count += 1
+
+
+# The RequestCounter of the current context, if any. User.set_points() passes it to its threads
+request_counter = ContextVar("request_counter", default=None)
+
+
+def get_leaderboard_url(p_game: str, p_category: str, p_variables: dict = {}, p_level: str = "") -> str:
+    """
+    Returns the url of a leaderboard with its players embedded.
+
+    Parameters
+    ----------
+    p_game : str        # The game's ID
+    p_category : str    # The category's ID
+    p_variables : dict  # The subcategory variables as {variable_id: value_id}
+    p_level : str       # The level's ID if the leaderboard is an Individual Level
+    """
+    # If the run is an Individual Level, adapt the request url
+    lvl_cat_str = "level/{level}/".format(level=p_level) if p_level else "category/"
+    url = "https://www.speedrun.com/api/v1/leaderboards/{game}/" \
+          "{lvl_cat_str}{category}?video-only=true&embed=players".format(game=p_game, lvl_cat_str=lvl_cat_str, category=p_category)
+    for var_id, var_value in p_variables.items():
+        url += "&var-{id}={value}".format(id=var_id, value=var_value)
+    return url
+
+
+def get_subcategory_ids(p_game: str) -> list:
+    """
+    Returns the IDs of a game's subcategory variables.
+
+    Parameters
+    ----------
+    p_game : str   # The game's ID
+    """
+    url = "https://www.speedrun.com/api/v1/games/{game}/variables".format(game=p_game)
+    game_variables = get_file(url)
+    game_subcategory_ids = []
+    for game_variable in game_variables["data"]:
+        if game_variable["is-subcategory"]:
+            game_subcategory_ids.append(game_variable["id"])
+    return game_subcategory_ids
+
+
+def get_subcategory_variables(p_values: dict, p_subcategory_ids: list) -> dict:
+    """
+    Returns the subset of a run's variables that are subcategories of its game.
+
+    Parameters
+    ----------
+    p_values : dict           # The run's variables as {variable_id: value_id}
+    p_subcategory_ids : list  # The game's subcategory variables, see get_subcategory_ids()
+    """
+    subcategory_variables = {}
+    # For every variable in the run...
+    for var_id, var_value in p_values.items():
+        # ...find if said variable is one of the game's subcategories...
+        if var_id in p_subcategory_ids:
+            # ... and add it to the run's subcategory variables
+            subcategory_variables[var_id] = var_value
+    return subcategory_variables
+
+
 def get_file(p_url: str) -> dict:
     """
     Returns the content of "url" parsed as JSON dict.
@@ -306,6 +519,9 @@ def get_file(p_url: str) -> dict:
     global session
     print(p_url)  # debugstr
     while True:
+        counter = request_counter.get()
+        if counter is not None:
+            counter.increment()
         try:
             rawdata = session.get(p_url)
         except requests.exceptions.ConnectionError as exception:  # Connexion error
@@ -367,6 +583,7 @@ def get_updated_user(p_user_id: str, p_statusLabel: object) -> str:
     global threadsException
     threadsException = []
     text_output = p_user_id
+    update_profile_token = stage_timer.start_capture()
 
     try:
         # Send to Web App
@@ -375,22 +592,24 @@ def get_updated_user(p_user_id: str, p_statusLabel: object) -> str:
 
         Thread(target=send_to_webapp, args=(p_user_id,)).start()
 
-        # Check if already connected
-        if not (gs_client and worksheet):
-            # Authentify to Google Sheets API
-            statusLabel.configure(text="Establishing connexion to online Spreadsheet...")
-            gs_client = gspread.authorize(credentials)
-            print("https://docs.google.com/spreadsheets/d/{spreadsheet}\n".format(spreadsheet=SPREADSHEET_ID))
-            worksheet = gs_client.open_by_key(SPREADSHEET_ID).sheet1
+        with stage_timer.stage("authenticate"):
+            # Check if already connected
+            if not (gs_client and worksheet):
+                # Authentify to Google Sheets API
+                statusLabel.configure(text="Establishing connexion to online Spreadsheet...")
+                gs_client = gspread.authorize(get_credentials())
+                print("https://docs.google.com/spreadsheets/d/{spreadsheet}\n".format(spreadsheet=SPREADSHEET_ID))
+                worksheet = gs_client.open_by_key(SPREADSHEET_ID).sheet1
 
-        # Refresh credentials
-        gs_client.login()
+            # Refresh credentials
+            gs_client.login()
         statusLabel.configure(text="Fetching online data from speedrun.com. Please wait...")
         user = User(p_user_id)
         print("{}\n{}".format(SEPARATOR, user._name))  # debugstr
 
         update_progress(0, 2)
-        user.set_code_and_name()
+        with stage_timer.stage("fetch user"):
+            user.set_code_and_name()
         user.set_points()
         update_progress(1, 0)  # Because user.set_code_and_name() is too fast
 
@@ -400,27 +619,18 @@ def get_updated_user(p_user_id: str, p_statusLabel: object) -> str:
                 print("\nLooking for {}".format(user._id))  # debugstr
 
                 # Try and find the user by its id_
-                worksheet = gs_client.open_by_key(SPREADSHEET_ID).sheet1
-                row = 0
-                # As of 2017/07/16 with current code searching by range is faster than col_values most of the time
-                # t1 = time.time()
-                row_count = worksheet.row_count
-                print("slow call to GSheets")
-                cell_list = worksheet.range(ROW_FIRST, COL_USERID, row_count, COL_USERID)
-                print("slow call done")
-                for cell in cell_list:
-                    if cell.value == user._id:
-                        row = cell.row
-                        break
-                # t2 = time.time()
-                # row_count = 0
-                # cell_values_list = worksheet.col_values(COL_USERID)
-                # for value in cell_values_list:
-                #    row_count += 1
-                #    if value == user._id: row = row_count
-                # t3 = time.time()
-                # print("range took    : {} seconds\ncol_values took: {} seconds".format(t2-t1, t3-t2))
-                # print("worksheet.range itself took {} seconds".format(tr2-tr1))
+                with stage_timer.stage("sheet lookup"):
+                    worksheet = gs_client.open_by_key(SPREADSHEET_ID).sheet1
+                    row = 0
+                    # As of 2017/07/16 with current code searching by range is faster than col_values most of the time
+                    row_count = worksheet.row_count
+                    print("slow call to GSheets")
+                    cell_list = worksheet.range(ROW_FIRST, COL_USERID, row_count, COL_USERID)
+                    print("slow call done")
+                    for cell in cell_list:
+                        if cell.value == user._id:
+                            row = cell.row
+                            break
                 timestamp = time.strftime("%Y/%m/%d %H:%M")
                 linked_name = "=HYPERLINK(\"{}\";\"{}\")".format(user._weblink, user._name)
                 if row >= ROW_FIRST:
@@ -429,7 +639,8 @@ def get_updated_user(p_user_id: str, p_statusLabel: object) -> str:
                     cell_list[0].value = linked_name
                     cell_list[1].value = user._points
                     cell_list[2].value = timestamp
-                    worksheet.update_cells(cell_list)
+                    with stage_timer.stage("sheet write"):
+                        worksheet.update_cells(cell_list)
                 # If user not found, add a row to the spreadsheet
                 else:
                     text_output = "{} not found. Added a new row.".format(user)
@@ -438,9 +649,13 @@ def get_updated_user(p_user_id: str, p_statusLabel: object) -> str:
                               user._points,
                               timestamp,
                               user._id]
-                    worksheet.insert_row(values, index=row_count + 1)
-                text_output += user._point_distribution_str
+                    with stage_timer.stage("sheet write"):
+                        worksheet.insert_row(values, index=row_count + 1)
+                # Only cache complete breakdowns that made it to the scoreboard
+                user._point_distribution = point_distributions.put(user._id, p_user_id, user._point_distribution)
+                text_output += user._point_distribution.to_str()
             else:
+                point_distributions.remove(user._id)
                 text_output = "Not updloading data as {} {}.".format(user, "is banned" if user._banned else "has a score of 0")
 
         else:
@@ -470,6 +685,146 @@ def get_updated_user(p_user_id: str, p_statusLabel: object) -> str:
         raise UserUpdaterError({"error": "Authorization problems",
                                 "details": "{}\nThis version of the app may be outdated. "
                                            "Please see https://github.com/Avasam/Global_Speedrunning_Scoreboard/releases".format(exception)})
+    finally:
+        stage_timer.stop_capture(update_profile_token)
+
+
+def update_user_retrying(p_user_id: str, p_statusLabel: object, p_check_for_pause: callable = None) -> str:
+    """Called from the auto-updaters. Same as get_updated_user(), but retries on retryable Google Sheets errors"""
+    while True:
+        if p_check_for_pause: p_check_for_pause()
+        try:
+            return get_updated_user(p_user_id, p_statusLabel)
+        except gspread.exceptions.RequestError as exception:
+            if exception.args[0] in HTTP_RETRYABLE_ERRORS:
+                print("WARNING: {}. Retrying in {} seconds.".format(exception.args[0], HTTPERROR_RETRY_DELAY))  # debugstr
+                time.sleep(HTTPERROR_RETRY_DELAY)
+            else:
+                raise UserUpdaterError({"error": "Unhandled RequestError", "details": traceback.format_exc()})
+        except Exception:
+            raise UserUpdaterError({"error": "Unhandled", "details": traceback.format_exc()})
+
+
+class ConsoleStatusLabel:
+    """Stands in for the UI's status label when updating from the command line"""
+    text = ""
+
+    def configure(self, text: str) -> None:
+        self.text = text
+
+
+def get_signup_user_ids(p_max_users: int = None) -> iter:
+    """
+    Yields the IDs of speedrun.com's users in signup order, as walked by AutoUpdateUsers.
+
+    Parameters
+    ----------
+    p_max_users : int   # Stop after this many users. None to walk every user
+    """
+    url = AutoUpdateUsers.BASE_URL
+    yielded = 0
+    while url:
+        users = get_file(url)
+        for user in users["data"]:
+            if p_max_users is not None and yielded >= p_max_users: return
+            yield user["id"]
+            yielded += 1
+        url = next((link["uri"] for link in users["pagination"]["links"] if link["rel"] == "next"), None)
+
+
+def record_snapshot(p_path: str, p_user_ids: iter) -> None:
+    """
+    Records every leaderboard the users' PBs are on to a snapshot for scoring.py, without touching the scoreboard.
+    The snapshot is written every SNAPSHOT_WRITE_INTERVAL users, and once more at the end.
+
+    Parameters
+    ----------
+    p_path : str        # The snapshot file to write
+    p_user_ids : iter   # The names or IDs of the users to go through
+    """
+    global snapshot_writer
+    global statusLabel
+    global statusLabel_current
+    global statusLabel_max
+    global threadsException
+    statusLabel = ConsoleStatusLabel()
+    snapshot_writer = LeaderboardSnapshotWriter()
+    try:
+        for recorded_users, user_id in enumerate(p_user_ids, 1):
+            statusLabel_current = 0
+            statusLabel_max = 0
+            threadsException = []
+            user = User(user_id)
+            try:
+                user.set_code_and_name()
+                user.set_points()
+            except UserUpdaterError as exception:
+                print("WARNING: Skipping user {}. {}".format(user_id, exception.args[0]["details"]))  # debugstr
+            for exception in threadsException:
+                print("WARNING: Some leaderboards of {} are missing. {}".format(user_id, exception["details"]))  # debugstr
+            print("Recorder @ user {}: {} leaderboards".format(recorded_users, len(snapshot_writer)))
+            if recorded_users % SNAPSHOT_WRITE_INTERVAL == 0:
+                snapshot_writer.write(p_path)
+    finally:
+        snapshot_writer.write(p_path)
+        snapshot_writer = None
+
+
+class UpdateQueue:
+    """
+    Thread-safe priority queue of user IDs to update. The highest priority is popped first, FIFO on ties.
+    Pushing a user that is already queued only ever raises its priority, so each user is updated once.
+    """
+
+    def __init__(self) -> None:
+        self._heap = []
+        self._priorities = {}
+        self._counter = count()
+        self._lock = Lock()
+
+    def __len__(self) -> int:
+        return len(self._priorities)
+
+    def __contains__(self, p_user_id: str) -> bool:
+        return p_user_id in self._priorities
+
+    def push(self, p_user_id: str, p_priority: float) -> bool:
+        """Returns True if the user was queued or had its priority raised"""
+        with self._lock:
+            if p_user_id in self._priorities and self._priorities[p_user_id] >= p_priority:
+                return False
+            self._priorities[p_user_id] = p_priority
+            # Any previous entry of this user is left in the heap and skipped once popped
+            heapq.heappush(self._heap, (-p_priority, next(self._counter), p_user_id))
+            return True
+
+    def pop(self) -> str:
+        """Returns the user ID with the highest priority or None if the queue is empty"""
+        with self._lock:
+            while self._heap:
+                priority, _, user_id = heapq.heappop(self._heap)
+                if self._priorities.get(user_id) == -priority:
+                    del self._priorities[user_id]
+                    return user_id
+            return None
+
+
+def get_update_priority(p_last_update: str, p_points: float, p_recent_runs: int) -> float:
+    """
+    Returns how valuable updating a user is. Stale, high scoring and active users come first.
+
+    Parameters
+    ----------
+    p_last_update : str   # The user's COL_LAST_UPDATE value
+    p_points : float      # The user's current points
+    p_recent_runs : int   # The amount of the user's runs that were verified recently
+    """
+    try:
+        staleness = max(0.0, time.time() - time.mktime(time.strptime(p_last_update, "%Y/%m/%d %H:%M"))) / 86400  # In days
+    except (TypeError, ValueError):
+        staleness = SCHEDULER_MAX_STALENESS  # Never updated or unreadable
+    staleness = min(staleness, SCHEDULER_MAX_STALENESS)
+    return staleness * (1 + max(p_points, 0) / SCHEDULER_POINTS_WEIGHT) * (1 + p_recent_runs * SCHEDULER_ACTIVITY_WEIGHT)
 
 
 # !Autoupdater
@@ -488,23 +843,7 @@ class AutoUpdateUsers(Thread):
 
     def run(self):
         def auto_updater_thread(user):
-            while True:
-                self.__check_for_pause()
-            # try:
-                try:
-                    get_updated_user(user["id"], self.statusLabel)
-                    break
-                except gspread.exceptions.RequestError as exception:
-                    if exception.args[0] in HTTP_RETRYABLE_ERRORS:
-                        print("WARNING: {}. Retrying in {} seconds.".format(exception.args[0], HTTPERROR_RETRY_DELAY))  # debugstr
-                        time.sleep(HTTPERROR_RETRY_DELAY)
-                    else:
-                        raise UserUpdaterError({"error": "Unhandled RequestError", "details": traceback.format_exc()})
-                except Exception:
-                    raise UserUpdaterError({"error": "Unhandled", "details": traceback.format_exc()})
-            # except UserUpdaterError as exception:
-            #     print("WARNING: Skipping user {}. {}".format(user["id"], exception.args[0]["details"]))  # debugstr
-            #     break
+            update_user_retrying(user["id"], self.statusLabel, self.__check_for_pause)
 
         # First update users from spreadsheet
         if AUTOUPDATER_SHEET_START >= ROW_FIRST:
@@ -513,7 +852,7 @@ class AutoUpdateUsers(Thread):
             if not (self.gs_client and self.worksheet):
                 # Authentify to Google Sheets API
                 self.statusLabel.configure(text="Establishing connexion to online Spreadsheet...")
-                gs_client = gspread.authorize(credentials)
+                gs_client = gspread.authorize(get_credentials())
                 print("https://docs.google.com/spreadsheets/d/{spreadsheet}\n".format(spreadsheet=SPREADSHEET_ID))
                 worksheet = gs_client.open_by_key(SPREADSHEET_ID).sheet1
             # Refresh credentials
@@ -568,3 +907,243 @@ class AutoUpdateUsers(Thread):
     def __check_for_pause(self):
         while self.paused:
             pass
+
+
+# !Feed updater
+class FeedUpdateUsers(Thread):
+    """
+    Polls the newly verified runs and only updates the users they affect:
+    the runs' players first, then the other players of the affected leaderboards as their points shift too.
+    Affected leaderboards wait in a backlog, whose players are queued as the queue goes under FEED_MAX_LEADERBOARD_PLAYERS.
+    """
+    BASE_URL = "https://www.speedrun.com/api/v1/runs?status=verified&orderby=verify-date&direction=desc&max=200"
+    PRIORITY_RUNNER = 2
+    PRIORITY_LEADERBOARD = 1
+    paused = True
+
+    def __init__(self, p_statusLabel, **kwargs):
+        Thread.__init__(self, **kwargs)
+        self.statusLabel = p_statusLabel
+        self.queue = UpdateQueue()
+        # Only runs verified after the feed updater started are considered new
+        self.last_verify_date = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+        self.last_run_ids = set()  # Runs already seen that were verified on last_verify_date
+        self.leaderboard_backlog = OrderedDict()  # {url: players left to queue, None if not fetched yet} oldest first
+
+    def run(self):
+        next_poll = 0
+        while True:
+            self.__check_for_pause()
+            if time.time() >= next_poll:
+                try:
+                    self.statusLabel.configure(text="Looking for newly verified runs...")
+                    self.__queue_new_runs()
+                except UserUpdaterError as exception:
+                    print("WARNING: Can't poll newly verified runs. {}".format(exception.args[0]["details"]))  # debugstr
+                try:
+                    self.__queue_leaderboard_players()
+                except UserUpdaterError as exception:
+                    print("WARNING: Can't queue the affected leaderboards' players. {}".format(exception.args[0]["details"]))  # debugstr
+                next_poll = time.time() + FEED_POLL_DELAY
+
+            user_id = self.queue.pop()
+            if user_id:
+                print("\nFeed updater @ {} user(s) left in queue".format(len(self.queue)))
+                try:
+                    update_user_retrying(user_id, self.statusLabel, self.__check_for_pause)
+                except UserUpdaterError as exception:
+                    print("WARNING: Skipping user {}. {}".format(user_id, exception.args[0]["details"]))  # debugstr
+            else:
+                self.statusLabel.configure(text="Waiting for newly verified runs...")
+                time.sleep(max(0, next_poll - time.time()))
+
+    def __queue_new_runs(self):
+        new_runs = []
+        url = self.BASE_URL
+        while url:
+            runs = get_file(url)
+            url = None
+            for run in runs["data"]:
+                verify_date = run["status"].get("verify-date") or ""
+                if verify_date < self.last_verify_date:
+                    break  # Runs are sorted by verify-date, everything past this one was already seen
+                if verify_date == self.last_verify_date and run["id"] in self.last_run_ids:
+                    continue  # Other runs verified on the same date can still be new
+                new_runs.append(run)
+            else:  # Every run of this page is new or on the last date, keep going
+                for link in runs["pagination"]["links"]:
+                    if link["rel"] == "next":
+                        url = link["uri"]
+        if not new_runs: return
+
+        # Remember where this poll stopped so the next one doesn't count the same runs twice
+        newest_verify_date = new_runs[0]["status"]["verify-date"]
+        newest_run_ids = {run["id"] for run in new_runs if run["status"]["verify-date"] == newest_verify_date}
+        if newest_verify_date == self.last_verify_date:
+            self.last_run_ids |= newest_run_ids
+        else:
+            self.last_verify_date = newest_verify_date
+            self.last_run_ids = newest_run_ids
+
+        # Find which leaderboards the new runs are part of and add them to the backlog
+        game_subcategory_ids = {}
+        leaderboards = set()
+        for run in new_runs:
+            for player in run["players"]:
+                if player.get("id"): self.queue.push(player["id"], self.PRIORITY_RUNNER)
+            if not FEED_MAX_LEADERBOARD_PLAYERS: continue  # Finding the leaderboards costs requests too
+            if not (run["category"] and run.get("videos")): continue  # Same validity check as in User.set_points()
+            if run["game"] not in game_subcategory_ids:
+                game_subcategory_ids[run["game"]] = get_subcategory_ids(run["game"])
+            variables = get_subcategory_variables(run["values"], game_subcategory_ids[run["game"]])
+            url = get_leaderboard_url(run["game"], run["category"], variables, run["level"])
+            leaderboards.add(url)
+            # A leaderboard already in the backlog is fetched again, as all of its players' points shifted again
+            self.leaderboard_backlog[url] = None
+        print("Feed updater: {} new run(s) in {} leaderboard(s), {} leaderboard(s) in backlog".format(
+            len(new_runs), len(leaderboards), len(self.leaderboard_backlog)))
+
+    def __queue_leaderboard_players(self):
+        # Each of these players costs a full update, so only keep up to FEED_MAX_LEADERBOARD_PLAYERS users queued.
+        # The rest stay in the backlog until the updates catch up
+        while self.leaderboard_backlog and len(self.queue) < FEED_MAX_LEADERBOARD_PLAYERS:
+            self.__check_for_pause()
+            url, players_left = next(iter(self.leaderboard_backlog.items()))
+            if players_left is None:
+                try:
+                    _, valid, player_offsets, players = compact_leaderboard(get_file(url))
+                except SpeedrunComError as exception:  # Not retryable, the leaderboard would block the backlog
+                    print("WARNING: Skipping leaderboard {}. {}".format(url, exception.args[0]["details"]))  # debugstr
+                    del self.leaderboard_backlog[url]
+                    continue
+                players_left = []
+                for i, is_valid in enumerate(valid):
+                    if is_valid: players_left.extend(players[player_offsets[i]:player_offsets[i + 1]])
+                players_left.reverse()  # Popped from the end, in leaderboard order
+                self.leaderboard_backlog[url] = players_left
+            while players_left and len(self.queue) < FEED_MAX_LEADERBOARD_PLAYERS:
+                self.queue.push(players_left.pop(), self.PRIORITY_LEADERBOARD)
+            if not players_left:
+                del self.leaderboard_backlog[url]
+
+    def __check_for_pause(self):
+        while self.paused:
+            pass
+
+
+# !Prioritized updater
+class PrioritizedUpdateUsers(Thread):
+    """
+    Updates the users of the spreadsheet by priority (see get_update_priority()) in cycles of SCHEDULER_CYCLE_DURATION.
+    Each cycle sends at most SCHEDULER_REQUEST_BUDGET requests to speedrun.com, skipping users whose estimated cost doesn't fit.
+    Only the requests sent by this updater count towards its budget.
+    """
+    paused = True
+
+    def __init__(self, p_statusLabel, **kwargs):
+        Thread.__init__(self, **kwargs)
+        self.statusLabel = p_statusLabel
+        self.worksheet = None
+        self.gs_client = None
+        self.queue = UpdateQueue()
+        self.request_counter = RequestCounter()
+        self.user_costs = {}  # {user_id: requests} measured on the last update of each user
+
+    def run(self):
+        request_counter.set(self.request_counter)
+        while True:
+            self.__check_for_pause()
+            cycle_end = time.time() + SCHEDULER_CYCLE_DURATION
+            cycle_start_request_count = self.request_counter.count
+            try:
+                self.statusLabel.configure(text="Prioritizing users to update...")
+                self.__queue_users()
+            except UserUpdaterError as exception:
+                print("WARNING: Can't prioritize users. {}".format(exception.args[0]["details"]))  # debugstr
+            except Exception:
+                print("WARNING: Can't prioritize users. {}".format(traceback.format_exc()))  # debugstr
+
+            while time.time() < cycle_end:
+                if self.__remaining_requests(cycle_start_request_count) < SCHEDULER_REQUESTS_PER_USER: break  # Not even the cheapest update fits
+                user_id = self.queue.pop()
+                if not user_id: break
+                try:
+                    cost = self.__estimate_cost(user_id)
+                    remaining_requests = self.__remaining_requests(cycle_start_request_count)
+                    if cost > remaining_requests:
+                        print("Prioritized updater: skipping user {} this cycle (~{} requests)".format(user_id, cost))  # debugstr
+                        continue
+                    print("\nPrioritized updater @ {}/{} requests, {} user(s) left in queue".format(
+                        SCHEDULER_REQUEST_BUDGET - remaining_requests, SCHEDULER_REQUEST_BUDGET, len(self.queue)))
+                    update_start_request_count = self.request_counter.count
+                    update_user_retrying(user_id, self.statusLabel, self.__check_for_pause)
+                    self.user_costs[user_id] = self.request_counter.count - update_start_request_count
+                except UserUpdaterError as exception:
+                    print("WARNING: Skipping user {}. {}".format(user_id, exception.args[0]["details"]))  # debugstr
+
+            self.statusLabel.configure(text="Waiting for the next update cycle...")
+            time.sleep(max(0, cycle_end - time.time()))
+
+    def __remaining_requests(self, p_cycle_start_request_count: int) -> int:
+        return SCHEDULER_REQUEST_BUDGET - (self.request_counter.count - p_cycle_start_request_count)
+
+    def __estimate_cost(self, p_user_id: str) -> int:
+        """Returns the requests the last update of this user took, or an estimate for SCHEDULER_DEFAULT_PB_COUNT PBs"""
+        if p_user_id in self.user_costs:
+            return self.user_costs[p_user_id]
+        # Counting the user's PBs would cost a request of its own, that the update would then send again
+        return SCHEDULER_REQUESTS_PER_USER + SCHEDULER_REQUESTS_PER_PB * SCHEDULER_DEFAULT_PB_COUNT
+
+    def __queue_users(self):
+        # Count the recently verified runs of every player
+        recent_runs = Counter()
+        runs = get_file(FeedUpdateUsers.BASE_URL)
+        for run in runs["data"]:
+            for player in run["players"]:
+                if player.get("id"): recent_runs[player["id"]] += 1
+
+        # Check if already connected
+        if not (self.gs_client and self.worksheet):
+            # Authentify to Google Sheets API
+            self.statusLabel.configure(text="Establishing connexion to online Spreadsheet...")
+            self.gs_client = gspread.authorize(get_credentials())
+            print("https://docs.google.com/spreadsheets/d/{spreadsheet}\n".format(spreadsheet=SPREADSHEET_ID))
+        # Refresh credentials
+        self.gs_client.login()
+        self.worksheet = self.gs_client.open_by_key(SPREADSHEET_ID).sheet1
+
+        row_count = self.worksheet.row_count
+        print("slow call to GSheets")
+        cell_list = self.worksheet.range(ROW_FIRST, COL_POINTS, row_count, COL_USERID)
+        print("slow call done")
+
+        # Cells are returned row by row, from COL_POINTS to COL_USERID
+        row_width = COL_USERID - COL_POINTS + 1
+        self.queue = UpdateQueue()
+        for i in range(0, len(cell_list) - row_width + 1, row_width):
+            row = cell_list[i:i + row_width]
+            user_id = row[COL_USERID - COL_POINTS].value
+            if not user_id: continue
+            try:
+                points = float(row[0].value)
+            except (TypeError, ValueError):
+                points = 0.0
+            last_update = row[COL_LAST_UPDATE - COL_POINTS].value
+            self.queue.push(user_id, get_update_priority(last_update, points, recent_runs[user_id]))
+        print("Prioritized updater: {} user(s) queued".format(len(self.queue)))
+
+    def __check_for_pause(self):
+        while self.paused:
+            pass
+
+
+if __name__ == "__main__":
+    # Leaderboard snapshots for scoring.py, without touching the scoreboard
+    import argparse
+    parser = argparse.ArgumentParser(description="Record the leaderboards of speedrun.com users to a snapshot that scoring.py can rescore offline")
+    parser.add_argument("snapshot", help="File to write")
+    parser.add_argument("--users", nargs="+", help="Names or IDs of the users to record. Defaults to every user in signup order")
+    parser.add_argument("--max-users", type=int, help="Stop after this many users")
+    args = parser.parse_args()
+
+    record_snapshot(args.snapshot, args.users[:args.max_users] if args.users else get_signup_user_ids(args.max_users))